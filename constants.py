@@ -0,0 +1,13 @@
+"""
+Shared constants for the Sparkplug B client and database viewer.
+"""
+
+# Database file written by mqtt-client.py and read by db-viewer.py
+DATABASE_FILE = "sparkplug_data.db"
+
+# Map Sparkplug B datatype numbers to display names
+DATATYPE_NAMES = {
+    1: "Int8", 2: "Int16", 3: "Int32", 4: "Int64", 5: "UInt8",
+    6: "UInt16", 7: "UInt32", 8: "UInt64", 9: "Float", 10: "Double",
+    11: "Boolean", 12: "String", 13: "DateTime", 14: "Text", 15: "UUID"
+}
@@ -7,11 +7,53 @@ This script provides a simple way to view the Sparkplug B data stored in the SQL
 
 import sqlite3
 import sys
-import datetime
+import time
 import argparse
+import functools
+import itertools
+import struct
+from constants import DATABASE_FILE, DATATYPE_NAMES
 
-# Database file
-DATABASE_FILE = "sparkplug_data.db"
+@functools.lru_cache(maxsize=4096)
+def format_timestamp(timestamp):
+    """Format a millisecond timestamp as local time.
+    
+    Metrics from one payload share a timestamp, so most rows hit the cache.
+    """
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp // 1000))
+
+def format_float32(value):
+    """Format a 32-bit float with the fewest digits that round-trip."""
+    try:
+        packed = struct.pack('f', value)
+    except OverflowError:
+        # Outside the float32 range, e.g. a Double value labelled as Float
+        return repr(value)
+    for precision in range(6, 9):
+        shortest = float(f"{value:.{precision}g}")
+        if struct.pack('f', shortest) == packed:
+            return repr(shortest)
+    return repr(value)
+
+def format_value(datatype, value_real, value_int, value_text):
+    """Format a metric value from whichever typed column holds it."""
+    datatype_name = DATATYPE_NAMES.get(datatype)
+    if value_real is not None:
+        return format_float32(value_real) if datatype_name == "Float" else str(value_real)
+    if value_int is not None:
+        return str(bool(value_int)) if datatype_name == "Boolean" else str(value_int)
+    return value_text if value_text is not None else ''
+
+def value_columns(cursor, table_alias='metrics'):
+    """Return the SELECT list for value_real, value_int and value_text.
+    
+    Databases the client has not migrated yet keep every value as text in a
+    single value column; read it as value_text so the report still works.
+    """
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(metrics)')}
+    if 'value' in columns:
+        return f"NULL AS value_real, NULL AS value_int, {table_alias}.value AS value_text"
+    return f"{table_alias}.value_real, {table_alias}.value_int, {table_alias}.value_text"
 
 def print_devices():
     """Print all devices stored in the database."""
@@ -25,9 +67,10 @@ def print_devices():
         ORDER BY group_id, node_id, device_id
         ''')
         
-        devices = cursor.fetchall()
+        # Stream rows from the cursor; peek at the first to detect an empty result
+        first = cursor.fetchone()
         
-        if not devices:
+        if first is None:
             print("No devices found in the database.")
             return
         
@@ -35,9 +78,9 @@ def print_devices():
         print(f"{'ID':<5} {'Group':<10} {'Node':<10} {'Device':<10} {'Timestamp':<20} {'Status':<10}")
         print("-" * 70)
         
-        for device in devices:
+        for device in itertools.chain((first,), cursor):
             device_id, group_id, node_id, device_id_str, timestamp, online = device
-            timestamp_str = datetime.datetime.fromtimestamp(timestamp/1000).strftime('%Y-%m-%d %H:%M:%S')
+            timestamp_str = format_timestamp(timestamp)
             status = "ONLINE" if online else "OFFLINE"
             print(f"{device_id:<5} {group_id:<10} {node_id:<10} {device_id_str or 'N/A':<10} {timestamp_str:<20} {status:<10}")
         
@@ -51,10 +94,10 @@ def print_latest_metrics(device_id=None, limit=10):
         conn = sqlite3.connect(DATABASE_FILE)
         cursor = conn.cursor()
         
-        query = '''
+        query = f'''
         SELECT 
             d.group_id, d.node_id, d.device_id,
-            m.name, m.datatype, m.value, m.timestamp
+            m.name, m.datatype, {value_columns(cursor, 'm')}, m.timestamp
         FROM metrics m
         JOIN devices d ON m.device_id = d.id
         '''
@@ -69,9 +112,10 @@ def print_latest_metrics(device_id=None, limit=10):
         
         cursor.execute(query, params)
         
-        metrics = cursor.fetchall()
+        # Stream rows from the cursor; peek at the first to detect an empty result
+        first = cursor.fetchone()
         
-        if not metrics:
+        if first is None:
             print(f"No metrics found for {'device ID ' + str(device_id) if device_id else 'any device'}.")
             return
         
@@ -79,17 +123,11 @@ def print_latest_metrics(device_id=None, limit=10):
         print(f"{'Group':<10} {'Node':<10} {'Device':<10} {'Metric Name':<20} {'Datatype':<10} {'Value':<20} {'Timestamp':<20}")
         print("-" * 100)
         
-        for metric in metrics:
-            group_id, node_id, device_id_str, name, datatype, value, timestamp = metric
-            timestamp_str = datetime.datetime.fromtimestamp(timestamp/1000).strftime('%Y-%m-%d %H:%M:%S')
-            
-            # Map datatype number to name (simplified)
-            datatype_names = {
-                1: "Int8", 2: "Int16", 3: "Int32", 4: "Int64", 5: "UInt8", 
-                6: "UInt16", 7: "UInt32", 8: "UInt64", 9: "Float", 10: "Double",
-                11: "Boolean", 12: "String", 13: "DateTime", 14: "Text"
-            }
-            datatype_name = datatype_names.get(datatype, str(datatype))
+        for metric in itertools.chain((first,), cursor):
+            group_id, node_id, device_id_str, name, datatype, value_real, value_int, value_text, timestamp = metric
+            value = format_value(datatype, value_real, value_int, value_text)
+            timestamp_str = format_timestamp(timestamp)
+            datatype_name = DATATYPE_NAMES.get(datatype, str(datatype))
             
             print(f"{group_id:<10} {node_id:<10} {device_id_str or 'N/A':<10} {name:<20} {datatype_name:<10} {value:<20} {timestamp_str:<20}")
         
@@ -118,25 +156,39 @@ def print_device_metrics(device_id):
         group_id, node_id, device_id_str = device
         print(f"\n=== Metrics for Device {device_id}: {group_id}/{node_id}/{device_id_str or 'N/A'} ===")
         
-        # Get metrics for this device
+        # Count the values recorded for each metric name
         cursor.execute('''
-        SELECT name, datatype, value, timestamp
+        SELECT name, COUNT(*)
         FROM metrics
         WHERE device_id = ?
-        ORDER BY name, timestamp DESC
+        GROUP BY name
         ''', (device_id,))
         
-        metrics = cursor.fetchall()
+        metric_counts = dict(cursor.fetchall())
         
-        if not metrics:
+        if not metric_counts:
             print("No metrics found for this device.")
             return
         
+        # Get only the latest 5 values of each metric for this device
+        cursor.execute(f'''
+        SELECT name, datatype, value_real, value_int, value_text, timestamp
+        FROM (
+            SELECT name, datatype, {value_columns(cursor)}, timestamp,
+                   ROW_NUMBER() OVER (PARTITION BY name ORDER BY timestamp DESC) AS rn
+            FROM metrics
+            WHERE device_id = ?
+        )
+        WHERE rn <= 5
+        ORDER BY name, timestamp DESC
+        ''', (device_id,))
+        
         # Group metrics by name
         metric_groups = {}
-        for name, datatype, value, timestamp in metrics:
+        for name, datatype, value_real, value_int, value_text, timestamp in cursor:
             if name not in metric_groups:
                 metric_groups[name] = []
+            value = format_value(datatype, value_real, value_int, value_text)
             metric_groups[name].append((datatype, value, timestamp))
         
         # Print metrics by name
@@ -145,22 +197,14 @@ def print_device_metrics(device_id):
             print(f"{'Datatype':<10} {'Value':<20} {'Timestamp':<20}")
             print("-" * 50)
             
-            # Print only the latest 5 values
-            for datatype, value, timestamp in values[:5]:
-                timestamp_str = datetime.datetime.fromtimestamp(timestamp/1000).strftime('%Y-%m-%d %H:%M:%S')
-                
-                # Map datatype number to name (simplified)
-                datatype_names = {
-                    1: "Int8", 2: "Int16", 3: "Int32", 4: "Int64", 5: "UInt8", 
-                    6: "UInt16", 7: "UInt32", 8: "UInt64", 9: "Float", 10: "Double",
-                    11: "Boolean", 12: "String", 13: "DateTime", 14: "Text"
-                }
-                datatype_name = datatype_names.get(datatype, str(datatype))
+            for datatype, value, timestamp in values:
+                timestamp_str = format_timestamp(timestamp)
+                datatype_name = DATATYPE_NAMES.get(datatype, str(datatype))
                 
                 print(f"{datatype_name:<10} {value:<20} {timestamp_str:<20}")
             
-            if len(values) > 5:
-                print(f"... and {len(values) - 5} more values")
+            if metric_counts[name] > 5:
+                print(f"... and {metric_counts[name] - 5} more values")
         
         conn.close()
     except Exception as e:
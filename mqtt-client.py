@@ -7,14 +7,19 @@ and stores the data in a SQLite database.
 """
 
 import os
+import re
 import sys
+import math
+import argparse
 import time
 import json
 import sqlite3
 import datetime
+import queue
+import threading
 import paho.mqtt.client as mqtt
 import sparkplug_b_pb2
-from google.protobuf.json_format import MessageToDict
+from constants import DATABASE_FILE
 
 # Configuration
 MQTT_HOST = "localhost"  # Change to your MQTT broker address
@@ -23,15 +28,133 @@ MQTT_KEEPALIVE = 60
 MQTT_USERNAME = None  # Set if your broker requires auth
 MQTT_PASSWORD = None
 SPARKPLUG_TOPIC = "spBv1.0/#"  # Standard Sparkplug B topic namespace
-DATABASE_FILE = "sparkplug_data.db"
+FLUSH_INTERVAL = 0.2  # Seconds between group commits
+FLUSH_BATCH_SIZE = 500  # Maximum messages written per transaction
+MESSAGE_QUEUE_SIZE = 10000  # Messages buffered between the MQTT and writer threads
+
+# Messages dropped because the writer thread fell behind
+dropped_messages = 0
+
+# Message types that change a device's online state
+LIFECYCLE_MESSAGES = frozenset({"NBIRTH", "DBIRTH", "NDEATH", "DDEATH"})
+DEATH_MESSAGES = frozenset({"NDEATH", "DDEATH"})
+
+# devices.id for each (group_id, node_id, device_id) seen by the writer thread
+device_id_cache = {}
+
+# SQL used on every message; kept as constants so sqlite3's statement cache hits
+SQL_UPSERT_DEVICE = '''
+INSERT INTO devices (group_id, node_id, device_id, timestamp, online)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT(group_id, node_id, device_id)
+DO UPDATE SET timestamp=?, online=?
+RETURNING id
+'''
+
+SQL_INSERT_METRIC = '''
+INSERT INTO metrics (device_id, name, timestamp, datatype, value_real, value_int, value_text)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
+# Metric value field populated for each Sparkplug B datatype
+VALUE_FIELD_BY_DATATYPE = {
+    sparkplug_b_pb2.DataType.Int8: 'intValue',
+    sparkplug_b_pb2.DataType.Int16: 'intValue',
+    sparkplug_b_pb2.DataType.Int32: 'intValue',
+    sparkplug_b_pb2.DataType.UInt8: 'intValue',
+    sparkplug_b_pb2.DataType.UInt16: 'intValue',
+    sparkplug_b_pb2.DataType.UInt32: 'intValue',
+    sparkplug_b_pb2.DataType.Int64: 'longValue',
+    sparkplug_b_pb2.DataType.UInt64: 'longValue',
+    sparkplug_b_pb2.DataType.DateTime: 'longValue',
+    sparkplug_b_pb2.DataType.Float: 'floatValue',
+    sparkplug_b_pb2.DataType.Double: 'doubleValue',
+    sparkplug_b_pb2.DataType.Boolean: 'booleanValue',
+    sparkplug_b_pb2.DataType.String: 'stringValue',
+    sparkplug_b_pb2.DataType.Text: 'stringValue',
+    sparkplug_b_pb2.DataType.UUID: 'stringValue',
+}
+VALUE_FIELDS = ('intValue', 'longValue', 'floatValue', 'doubleValue',
+                'booleanValue', 'stringValue')
+
+# Position of the typed column (value_real, value_int, value_text) each field
+# is stored in; booleans are stored as 0/1 in value_int
+VALUE_COLUMN_BY_FIELD = {
+    'floatValue': 0,
+    'doubleValue': 0,
+    'intValue': 1,
+    'longValue': 1,
+    'booleanValue': 1,
+    'stringValue': 2,
+}
+
+# Datatypes migrate_metric_values() moves into value_real and value_int
+REAL_DATATYPES = (
+    sparkplug_b_pb2.DataType.Float,
+    sparkplug_b_pb2.DataType.Double,
+)
+INTEGER_DATATYPES = (
+    sparkplug_b_pb2.DataType.Int8,
+    sparkplug_b_pb2.DataType.Int16,
+    sparkplug_b_pb2.DataType.Int32,
+    sparkplug_b_pb2.DataType.Int64,
+    sparkplug_b_pb2.DataType.UInt8,
+    sparkplug_b_pb2.DataType.UInt16,
+    sparkplug_b_pb2.DataType.UInt32,
+    sparkplug_b_pb2.DataType.UInt64,
+    sparkplug_b_pb2.DataType.DateTime,
+)
+
+# Numeric spellings the old client wrote for Float/Double values
+LEGACY_REAL_PATTERN = re.compile(r'[+-]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?|-?Infinity')
+
+# Bit width of the signed datatypes, which Sparkplug carries as two's
+# complement in the unsigned intValue (uint32) or longValue (uint64) field
+SIGNED_BITS_BY_DATATYPE = {
+    sparkplug_b_pb2.DataType.Int8: 8,
+    sparkplug_b_pb2.DataType.Int16: 16,
+    sparkplug_b_pb2.DataType.Int32: 32,
+    sparkplug_b_pb2.DataType.Int64: 64,
+    sparkplug_b_pb2.DataType.DateTime: 64,
+}
+INT64_MAX = 2 ** 63 - 1  # Largest value SQLite can store as INTEGER
+
+def to_signed(value, bits):
+    """Interpret the low bits of an unsigned value as a two's complement integer."""
+    value &= (1 << bits) - 1
+    return value - (1 << bits) if value >> (bits - 1) else value
 
 # Setup SQLite database
-def setup_database():
-    """Initialize the SQLite database with the required tables."""
-    conn = sqlite3.connect(DATABASE_FILE)
+def setup_database(conn, bulk_load=False):
+    """Initialize the SQLite database with the required tables.
+    
+    In bulk-load mode the metrics indexes are dropped so inserts skip index
+    maintenance; call ensure_indexes() once ingestion is finished.
+    """
+    cursor = conn.cursor()
+    
+    # Tune the connection for a write-heavy ingest workload. journal_mode=WAL
+    # is persisted in the database file; the others apply to this connection.
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA cache_size=-50000')
+    cursor.execute('PRAGMA mmap_size=268435456')
+    
+    ensure_tables(conn)
+    migrate_metric_values(conn)
+    
+    if bulk_load:
+        drop_indexes(conn)
+    else:
+        ensure_indexes(conn)
+    
+    print("Database setup complete.")
+
+def ensure_tables(conn):
+    """Create the tables for the Sparkplug B data model."""
     cursor = conn.cursor()
     
-    # Create tables for the Sparkplug B data model
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS devices (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -51,18 +174,109 @@ def setup_database():
         name TEXT,
         timestamp INTEGER,
         datatype INTEGER,
-        value TEXT,
+        value_real REAL,
+        value_int INTEGER,
+        value_text TEXT,
         FOREIGN KEY (device_id) REFERENCES devices(id)
     )
     ''')
+
+def migrate_metric_values(conn):
+    """Move values from the old TEXT value column into the typed columns."""
+    cursor = conn.cursor()
+    
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(metrics)')}
+    if 'value' not in columns:
+        return
     
+    print("Migrating metric values to typed columns...")
+    cursor.execute('BEGIN IMMEDIATE')
+    cursor.execute('ALTER TABLE metrics ADD COLUMN value_real REAL')
+    cursor.execute('ALTER TABLE metrics ADD COLUMN value_int INTEGER')
+    cursor.execute('ALTER TABLE metrics ADD COLUMN value_text TEXT')
+    
+    # Float, Double. CAST would turn non-numeric text and 'NaN' into 0.0, so
+    # only convert recognised numbers; the rest fall through to value_text.
+    # NaN stays text too, since SQLite stores a bound NaN as NULL.
+    cursor.execute(f'''
+    SELECT id, value FROM metrics
+    WHERE datatype IN ({', '.join('?' * len(REAL_DATATYPES))})
+    ''', REAL_DATATYPES)
+    updates = []
+    for row_id, value in cursor.fetchall():
+        if isinstance(value, str) and LEGACY_REAL_PATTERN.fullmatch(value):
+            updates.append((float(value), row_id))
+    cursor.executemany('UPDATE metrics SET value_real = ? WHERE id = ?', updates)
+    # Integer types and DateTime; CAST saturates out-of-range values, so only
+    # take those that survive the round trip
+    cursor.execute(f'''
+    UPDATE metrics SET value_int = CAST(value AS INTEGER)
+    WHERE datatype IN ({', '.join('?' * len(INTEGER_DATATYPES))})
+    AND CAST(CAST(value AS INTEGER) AS TEXT) = value
+    ''', INTEGER_DATATYPES)
+    # Signed integers were written as their unsigned two's complement;
+    # convert them back. Values wider than the datatype's protobuf field came
+    # from a mislabelled field and are left as they are.
+    signed_datatypes = tuple(SIGNED_BITS_BY_DATATYPE)
+    cursor.execute(f'''
+    SELECT id, datatype, value FROM metrics
+    WHERE datatype IN ({', '.join('?' * len(signed_datatypes))})
+    ''', signed_datatypes)
+    updates = []
+    for row_id, datatype, value in cursor.fetchall():
+        if not (isinstance(value, str) and value.isascii() and value.isdigit()):
+            continue
+        number = int(value)
+        bits = SIGNED_BITS_BY_DATATYPE[datatype]
+        field_bits = 32 if bits <= 32 else 64
+        if number < 1 << field_bits:
+            updates.append((to_signed(number, bits), row_id))
+    cursor.executemany('UPDATE metrics SET value_int = ? WHERE id = ?', updates)
+    # Boolean (stored as "True"/"False")
+    cursor.execute('''
+    UPDATE metrics SET value_int = (value = 'True') WHERE datatype = ?
+    ''', (sparkplug_b_pb2.DataType.Boolean,))
+    # Everything else, including UInt64 values too large for INTEGER, stays text
     cursor.execute('''
-    CREATE INDEX IF NOT EXISTS idx_metrics_device ON metrics(device_id)
+    UPDATE metrics SET value_text = value WHERE value_real IS NULL AND value_int IS NULL
     ''')
     
+    cursor.execute('ALTER TABLE metrics DROP COLUMN value')
     conn.commit()
-    conn.close()
-    print("Database setup complete.")
+
+def ensure_indexes(conn):
+    """Create any missing metrics indexes and keep planner statistics current."""
+    cursor = conn.cursor()
+    
+    existing = {row[0] for row in cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'metrics'"
+    )}
+    
+    # The composite index serves both device filtering and newest-first
+    # ordering, which makes the old single-column index redundant
+    cursor.execute('DROP INDEX IF EXISTS idx_metrics_device')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_metrics_device_ts ON metrics(device_id, timestamp DESC)
+    ''')
+    
+    # Lets "latest N metrics" queries stream in order and stop at the LIMIT
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_metrics_ts ON metrics(timestamp DESC)
+    ''')
+    
+    if {'idx_metrics_device_ts', 'idx_metrics_ts'} - existing:
+        # A full ANALYZE is only worth its table scan when an index was just
+        # built; the planner needs statistics to pick it up
+        cursor.execute('ANALYZE')
+    else:
+        cursor.execute('PRAGMA optimize')
+
+def drop_indexes(conn):
+    """Drop the metrics indexes ahead of a bulk load."""
+    cursor = conn.cursor()
+    cursor.execute('DROP INDEX IF EXISTS idx_metrics_device')
+    cursor.execute('DROP INDEX IF EXISTS idx_metrics_device_ts')
+    cursor.execute('DROP INDEX IF EXISTS idx_metrics_ts')
 
 # Parse Sparkplug B payloads
 def parse_payload(payload):
@@ -71,81 +285,156 @@ def parse_payload(payload):
         # Decode the protobuf message
         sparkplug_message = sparkplug_b_pb2.Payload()
         sparkplug_message.ParseFromString(payload)
-        
-        # Convert to Python dictionary for easier handling
-        payload_dict = MessageToDict(sparkplug_message)
-        return payload_dict
+        return sparkplug_message
     except Exception as e:
         print(f"Error parsing Sparkplug B payload: {e}")
         return None
 
+def metric_value_field(metric):
+    """Return the name of the field holding a metric's value, or None if unset."""
+    # The datatype normally tells us which field holds the value
+    field = VALUE_FIELD_BY_DATATYPE.get(metric.datatype)
+    if field is not None and metric.HasField(field):
+        return field
+    
+    # Fall back to scanning for publishers that mislabel the datatype
+    for field in VALUE_FIELDS:
+        if metric.HasField(field):
+            return field
+    return None
+
 # Extract and store device information and metrics
-def store_data(topic_parts, payload_dict):
-    """Store the Sparkplug B data in the SQLite database."""
-    try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        # Parse the Sparkplug B topic parts
-        # Format: spBv1.0/[group_id]/[message_type]/[edge_node_id]/[device_id]
-        group_id = topic_parts[1] if len(topic_parts) > 1 else None
-        message_type = topic_parts[2] if len(topic_parts) > 2 else None
-        node_id = topic_parts[3] if len(topic_parts) > 3 else None
-        device_id = topic_parts[4] if len(topic_parts) > 4 else None
-        
+def store_data(cursor, group_id, message_type, node_id, device_id, payload):
+    """Store the Sparkplug B data within the caller's open transaction.
+    
+    Errors propagate so the caller can roll back the whole message.
+    """
+    # Timestamp (use the one in the payload or current time)
+    if payload.HasField('timestamp'):
+        timestamp = payload.timestamp
+    else:
+        timestamp = int(time.time() * 1000)
+    
+    # Insert or update device information. Only births, deaths and
+    # first sightings touch the devices table; data messages reuse the
+    # cached row id.
+    key = (group_id, node_id, device_id)
+    device_row_id = device_id_cache.get(key)
+    if device_row_id is None or message_type in LIFECYCLE_MESSAGES:
         # Determine if the device is online based on message type
-        online = 1
-        if message_type in ["NDEATH", "DDEATH"]:
-            online = 0
-        
-        # Timestamp (use the one in the payload or current time)
-        timestamp = int(payload_dict.get('timestamp', int(time.time() * 1000)))
-        
-        # Insert or update device information
-        cursor.execute('''
-        INSERT INTO devices (group_id, node_id, device_id, timestamp, online)
-        VALUES (?, ?, ?, ?, ?)
-        ON CONFLICT(group_id, node_id, device_id) 
-        DO UPDATE SET timestamp=?, online=?
-        ''', (group_id, node_id, device_id, timestamp, online, timestamp, online))
-        
-        device_row_id = cursor.lastrowid
-        if not device_row_id:
-            # If no new row was inserted, get the existing device ID
-            cursor.execute('''
-            SELECT id FROM devices WHERE group_id=? AND node_id=? AND device_id=?
-            ''', (group_id, node_id, device_id))
-            device_row_id = cursor.fetchone()[0]
+        online = 0 if message_type in DEATH_MESSAGES else 1
+        device_row_id = cursor.execute(
+            SQL_UPSERT_DEVICE,
+            (group_id, node_id, device_id, timestamp, online, timestamp, online)
+        ).fetchone()[0]
+        device_id_cache[key] = device_row_id
+    
+    # Collect metrics so they can be inserted in a single batch
+    rows = []
+    for metric in payload.metrics:
+        field = metric_value_field(metric)
+        if field is not None:
+            value = getattr(metric, field)
+            column = VALUE_COLUMN_BY_FIELD[field]
+            bits = SIGNED_BITS_BY_DATATYPE.get(metric.datatype)
+            if bits is not None and field == VALUE_FIELD_BY_DATATYPE[metric.datatype]:
+                # Signed integers arrive as two's complement in an unsigned field
+                value = to_signed(value, bits)
+            elif field == 'longValue' and value > INT64_MAX:
+                # UInt64 values beyond SQLite's INTEGER range stay exact as text
+                value = str(value)
+                column = 2
+            elif column == 0 and math.isnan(value):
+                # SQLite stores a bound NaN as NULL, so keep it as text
+                value = 'NaN'
+                column = 2
+            
+            # Fill exactly one of value_real, value_int, value_text
+            values = [None, None, None]
+            values[column] = value
+            rows.append((device_row_id, metric.name, timestamp,
+                         metric.datatype, *values))
+    
+    if rows:
+        cursor.executemany(SQL_INSERT_METRIC, rows)
+    
+    print(f"Stored data for {group_id}/{node_id}/{device_id}")
+
+# Decode and store messages off the MQTT network thread
+def write_batch(conn, batch):
+    """Decode a batch of raw messages and store them in one transaction."""
+    # Decode before taking the write lock
+    decoded = []
+    for topic, raw_payload in batch:
+        # Split the topic into its components
+        # Format: spBv1.0/[group_id]/[message_type]/[edge_node_id]/[device_id]
+        topic_parts = topic.split('/', 4)
+        if len(topic_parts) < 4:
+            print(f"Incomplete Sparkplug B topic {topic}, skipping.")
+            continue
         
-        # Process metrics if present
-        if 'metrics' in payload_dict:
-            for metric in payload_dict['metrics']:
-                # Extract metric name and value
-                name = metric.get('name', '')
-                
-                # Handle different data types - store the value and datatype
-                datatype = metric.get('datatype', 0)
-                value = None
-                
-                # Get the appropriate value field based on datatype
-                for val_type in ['intValue', 'longValue', 'floatValue', 'doubleValue', 
-                                'booleanValue', 'stringValue', 'bytesValue']:
-                    if val_type in metric:
-                        value = str(metric[val_type])
-                        break
-                
-                if value is not None:
-                    # Store metric in database
-                    cursor.execute('''
-                    INSERT INTO metrics (device_id, name, timestamp, datatype, value)
-                    VALUES (?, ?, ?, ?, ?)
-                    ''', (device_row_id, name, timestamp, datatype, value))
+        # device_id is only present for device-level messages
+        group_id, message_type, node_id, device_id = (topic_parts + [None])[1:5]
         
+        payload = parse_payload(raw_payload)
+        if payload is None:
+            print("Failed to parse payload, skipping.")
+            continue
+        decoded.append((group_id, message_type, node_id, device_id, payload))
+    
+    if not decoded:
+        return
+    
+    try:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        for group_id, message_type, node_id, device_id, payload in decoded:
+            # A savepoint per message keeps a failing message from being
+            # half-written without discarding the rest of the batch
+            cursor.execute('SAVEPOINT msg')
+            try:
+                store_data(cursor, group_id, message_type, node_id, device_id, payload)
+            except Exception as e:
+                cursor.execute('ROLLBACK TO msg')
+                # The rolled-back upsert may have cached an id that doesn't exist
+                device_id_cache.pop((group_id, node_id, device_id), None)
+                print(f"Error storing data: {e}")
+            cursor.execute('RELEASE msg')
         conn.commit()
-        conn.close()
-        print(f"Stored data for {group_id}/{node_id}/{device_id}")
     except Exception as e:
-        print(f"Error storing data: {e}")
+        if conn.in_transaction:
+            conn.rollback()
+        # Rolled-back inserts may have left ids in the cache that don't exist
+        device_id_cache.clear()
+        print(f"Error committing {len(decoded)} messages: {e}")
+
+def writer_loop(conn, work_queue):
+    """Group-commit queued messages until a None sentinel is received.
+    
+    A batch is written once FLUSH_BATCH_SIZE messages have been collected or
+    FLUSH_INTERVAL has passed since its first message, whichever is sooner.
+    """
+    stopping = False
+    while not stopping:
+        batch = []
+        item = work_queue.get()
+        deadline = time.monotonic() + FLUSH_INTERVAL
+        while True:
+            if item is None:
+                stopping = True
+                break
+            batch.append(item)
+            
+            remaining = deadline - time.monotonic()
+            if len(batch) >= FLUSH_BATCH_SIZE or remaining <= 0:
+                break
+            try:
+                item = work_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+        
+        if batch:
+            write_batch(conn, batch)
 
 # MQTT Callbacks
 def on_connect(client, userdata, flags, rc):
@@ -157,34 +446,48 @@ def on_connect(client, userdata, flags, rc):
 
 def on_message(client, userdata, msg):
     """Callback when a message is received from the MQTT broker."""
+    global dropped_messages
     try:
         print(f"Received message on topic: {msg.topic}")
         
-        # Split the topic into its components
-        topic_parts = msg.topic.split('/')
-        
-        # Check if this is a Sparkplug B message
-        if topic_parts[0] != "spBv1.0":
+        # Check if this is a Sparkplug B message before doing any other work
+        if not msg.topic.startswith("spBv1.0/"):
             print("Not a Sparkplug B message, ignoring.")
             return
         
-        # Parse the payload
-        payload_dict = parse_payload(msg.payload)
-        if payload_dict:
-            # Store the data
-            store_data(topic_parts, payload_dict)
-        else:
-            print("Failed to parse payload, skipping.")
+        # Hand the raw message to the writer thread so decoding and storage
+        # never block the MQTT network loop
+        try:
+            userdata.put_nowait((msg.topic, msg.payload))
+        except queue.Full:
+            dropped_messages += 1
+            print(f"Writer queue full, dropped message ({dropped_messages} dropped so far).")
     except Exception as e:
         print(f"Error processing message: {e}")
 
 def main():
     """Main function to set up the MQTT client and database."""
+    parser = argparse.ArgumentParser(description='Store Sparkplug B MQTT data in a SQLite database')
+    parser.add_argument('--bulk-load', action='store_true',
+                        help='Drop the metrics indexes while ingesting and rebuild them on exit')
+    
+    args = parser.parse_args()
+    
+    # Open a single long-lived connection used by the writer thread
+    conn = sqlite3.connect(DATABASE_FILE, check_same_thread=False,
+                           isolation_level=None, cached_statements=128)
+    
     # Setup database
-    setup_database()
+    setup_database(conn, bulk_load=args.bulk_load)
+    
+    # Start the writer thread; from here on it is the only user of the connection
+    work_queue = queue.Queue(maxsize=MESSAGE_QUEUE_SIZE)
+    writer = threading.Thread(target=writer_loop, args=(conn, work_queue), daemon=True)
+    writer.start()
     
     # Setup MQTT client
     client = mqtt.Client()
+    client.user_data_set(work_queue)
     
     # Set username and password if configured
     if MQTT_USERNAME and MQTT_PASSWORD:
@@ -209,6 +512,12 @@ def main():
     finally:
         print("Disconnecting MQTT client...")
         client.disconnect()
+        work_queue.put(None)
+        writer.join()
+        if args.bulk_load:
+            print("Rebuilding metrics indexes...")
+            ensure_indexes(conn)
+        conn.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -23,79 +23,96 @@ GROUP_ID = "Group01"
 EDGE_NODE_ID = "Node01"
 DEVICE_ID = "Device01"
 
+# Metric value field, add_metric() keyword and default value for each datatype.
+# Datatypes without a value field in this schema (e.g. Bytes) are left unset.
+METRIC_VALUE_FIELDS = {
+    sparkplug_b_pb2.DataType.Int8: ('intValue', 'int_value', 0),
+    sparkplug_b_pb2.DataType.Int16: ('intValue', 'int_value', 0),
+    sparkplug_b_pb2.DataType.Int32: ('intValue', 'int_value', 0),
+    sparkplug_b_pb2.DataType.Int64: ('longValue', 'long_value', 0),
+    sparkplug_b_pb2.DataType.UInt8: ('intValue', 'int_value', 0),
+    sparkplug_b_pb2.DataType.UInt16: ('intValue', 'int_value', 0),
+    sparkplug_b_pb2.DataType.UInt32: ('intValue', 'int_value', 0),
+    sparkplug_b_pb2.DataType.UInt64: ('longValue', 'long_value', 0),
+    sparkplug_b_pb2.DataType.Float: ('floatValue', 'float_value', 0.0),
+    sparkplug_b_pb2.DataType.Double: ('doubleValue', 'double_value', 0.0),
+    sparkplug_b_pb2.DataType.Boolean: ('booleanValue', 'boolean_value', False),
+    sparkplug_b_pb2.DataType.String: ('stringValue', 'string_value', ""),
+    sparkplug_b_pb2.DataType.DateTime: ('longValue', 'long_value', None),
+    sparkplug_b_pb2.DataType.Text: ('stringValue', 'string_value', ""),
+    sparkplug_b_pb2.DataType.UUID: ('stringValue', 'string_value', ""),
+}
+
 def create_birth_payload():
     """Create a node birth (NBIRTH) message payload."""
+    # All metrics in the payload share one timestamp
+    now_ms = int(time.time() * 1000)
+    
     payload = sparkplug_b_pb2.Payload()
-    payload.timestamp = int(time.time() * 1000)
+    payload.timestamp = now_ms
     payload.seq = 0
     
     # Add some metrics
-    add_metric(payload, "Temperature", sparkplug_b_pb2.DataType.Float, float_value=22.5)
-    add_metric(payload, "Humidity", sparkplug_b_pb2.DataType.Float, float_value=45.0)
-    add_metric(payload, "Pressure", sparkplug_b_pb2.DataType.Float, float_value=1013.25)
-    add_metric(payload, "Status", sparkplug_b_pb2.DataType.Boolean, boolean_value=True)
-    add_metric(payload, "DeviceName", sparkplug_b_pb2.DataType.String, string_value="Environmental Sensor")
+    add_metric(payload, "Temperature", sparkplug_b_pb2.DataType.Float, timestamp=now_ms,
+               float_value=22.5)
+    add_metric(payload, "Humidity", sparkplug_b_pb2.DataType.Float, timestamp=now_ms,
+               float_value=45.0)
+    add_metric(payload, "Pressure", sparkplug_b_pb2.DataType.Float, timestamp=now_ms,
+               float_value=1013.25)
+    add_metric(payload, "Status", sparkplug_b_pb2.DataType.Boolean, timestamp=now_ms,
+               boolean_value=True)
+    add_metric(payload, "DeviceName", sparkplug_b_pb2.DataType.String, timestamp=now_ms,
+               string_value="Environmental Sensor")
     
     return payload.SerializeToString()
 
 def create_data_payload():
     """Create a device data (DDATA) message payload with random values."""
-    payload = sparkplug_b_pb2.Payload()
-    payload.timestamp = int(time.time() * 1000)
-    payload.seq = 0
+    # All metrics in the payload share one timestamp
+    now_ms = int(time.time() * 1000)
     
-    # Add some metrics with random values
-    add_metric(payload, "Temperature", sparkplug_b_pb2.DataType.Float, 
-               float_value=20.0 + random.uniform(0, 10))
-    add_metric(payload, "Humidity", sparkplug_b_pb2.DataType.Float, 
-               float_value=40.0 + random.uniform(0, 20))
-    add_metric(payload, "Pressure", sparkplug_b_pb2.DataType.Float, 
-               float_value=1000.0 + random.uniform(0, 30))
-    add_metric(payload, "Status", sparkplug_b_pb2.DataType.Boolean, 
-               boolean_value=random.choice([True, False]))
+    # Reuse the template; only the timestamps and values change
+    payload = DATA_PAYLOAD_TEMPLATE
+    payload.timestamp = now_ms
+    
+    temperature, humidity, pressure, status = payload.metrics
+    for metric in payload.metrics:
+        metric.timestamp = now_ms
+    
+    # Fill in random values
+    temperature.floatValue = 20.0 + random.uniform(0, 10)
+    humidity.floatValue = 40.0 + random.uniform(0, 20)
+    pressure.floatValue = 1000.0 + random.uniform(0, 30)
+    status.booleanValue = random.choice([True, False])
     
     return payload.SerializeToString()
 
-def add_metric(payload, name, datatype, **kwargs):
-    """Add a metric to the payload."""
+def add_metric(payload, name, datatype, timestamp, **kwargs):
+    """Add a metric with the given timestamp (ms since epoch) to the payload."""
     metric = payload.metrics.add()
     metric.name = name
-    metric.timestamp = int(time.time() * 1000)
+    metric.timestamp = timestamp
     metric.datatype = datatype
 
     # Set the appropriate value based on datatype
-    if datatype == sparkplug_b_pb2.DataType.Int8:
-        metric.intValue = kwargs.get('int_value', 0)
-    elif datatype == sparkplug_b_pb2.DataType.Int16:
-        metric.intValue = kwargs.get('int_value', 0)
-    elif datatype == sparkplug_b_pb2.DataType.Int32:
-        metric.intValue = kwargs.get('int_value', 0)
-    elif datatype == sparkplug_b_pb2.DataType.Int64:
-        metric.longValue = kwargs.get('long_value', 0)
-    elif datatype == sparkplug_b_pb2.DataType.UInt8:
-        metric.intValue = kwargs.get('int_value', 0)
-    elif datatype == sparkplug_b_pb2.DataType.UInt16:
-        metric.intValue = kwargs.get('int_value', 0)
-    elif datatype == sparkplug_b_pb2.DataType.UInt32:
-        metric.intValue = kwargs.get('int_value', 0)
-    elif datatype == sparkplug_b_pb2.DataType.UInt64:
-        metric.longValue = kwargs.get('long_value', 0)
-    elif datatype == sparkplug_b_pb2.DataType.Float:
-        metric.floatValue = kwargs.get('float_value', 0.0)
-    elif datatype == sparkplug_b_pb2.DataType.Double:
-        metric.doubleValue = kwargs.get('double_value', 0.0)
-    elif datatype == sparkplug_b_pb2.DataType.Boolean:
-        metric.booleanValue = kwargs.get('boolean_value', False)
-    elif datatype == sparkplug_b_pb2.DataType.String:
-        metric.stringValue = kwargs.get('string_value', "")
-    elif datatype == sparkplug_b_pb2.DataType.DateTime:
-        metric.longValue = kwargs.get('long_value', int(time.time() * 1000))
-    elif datatype == sparkplug_b_pb2.DataType.Text:
-        metric.stringValue = kwargs.get('string_value', "")
-    elif datatype == sparkplug_b_pb2.DataType.UUID:
-        metric.stringValue = kwargs.get('string_value', "")
-    elif datatype == sparkplug_b_pb2.DataType.Bytes:
-        metric.bytesValue = kwargs.get('bytes_value', b"")
+    value_field = METRIC_VALUE_FIELDS.get(datatype)
+    if value_field is None:
+        return
+    
+    field, key, default = value_field
+    if default is None:
+        # DateTime values default to the metric timestamp
+        default = timestamp
+    setattr(metric, field, kwargs.get(key, default))
+
+# DDATA payload reused by create_data_payload(); the metric names and datatypes
+# never change between messages
+DATA_PAYLOAD_TEMPLATE = sparkplug_b_pb2.Payload()
+DATA_PAYLOAD_TEMPLATE.seq = 0
+add_metric(DATA_PAYLOAD_TEMPLATE, "Temperature", sparkplug_b_pb2.DataType.Float, timestamp=0)
+add_metric(DATA_PAYLOAD_TEMPLATE, "Humidity", sparkplug_b_pb2.DataType.Float, timestamp=0)
+add_metric(DATA_PAYLOAD_TEMPLATE, "Pressure", sparkplug_b_pb2.DataType.Float, timestamp=0)
+add_metric(DATA_PAYLOAD_TEMPLATE, "Status", sparkplug_b_pb2.DataType.Boolean, timestamp=0)
 
 def on_connect(client, userdata, flags, rc):
     """Callback when the client connects to the MQTT broker."""